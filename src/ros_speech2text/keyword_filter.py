@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+import os
+import wave
+
+import numpy as np
+
+from .speech_detection import BUFFER_NP_TYPE
+
+
+FRAME_LENGTH = .025  # seconds
+FRAME_STEP = .01  # seconds
+N_MEL = 26
+N_MFCC = 13
+MAX_FREQUENCY = 4000.  # same for all rates so that features are comparable
+PRE_EMPHASIS = .97
+ENERGY_RATIO = .01  # frames below this fraction of max energy are trimmed
+LOG_FLOOR = 1e-4  # mel energies are floored at this fraction of their max
+
+
+def hz_to_mel(f):
+    return 2595. * np.log10(1. + f / 700.)
+
+
+def mel_to_hz(m):
+    return 700. * (10 ** (m / 2595.) - 1.)
+
+
+def mel_filterbank(rate, n_fft, n_mel=N_MEL):
+    """Triangular filters, evenly spaced on the mel scale.
+
+    :return: numpy array of shape (n_mel, n_fft // 2 + 1)
+    """
+    if rate < 2 * MAX_FREQUENCY:
+        raise ValueError('Sampling rate should be at least {} Hz.'.format(
+            int(2 * MAX_FREQUENCY)))
+    mel_points = np.linspace(hz_to_mel(0.), hz_to_mel(MAX_FREQUENCY),
+                             n_mel + 2)
+    bins = np.fft.rfftfreq(n_fft, 1. / rate)
+    hz_points = mel_to_hz(mel_points)
+    lower = hz_points[:-2, None]
+    center = hz_points[1:-1, None]
+    upper = hz_points[2:, None]
+    rising = (bins[None, :] - lower) / (center - lower)
+    falling = (upper - bins[None, :]) / (upper - center)
+    return np.maximum(0., np.minimum(rising, falling))
+
+
+def dct_matrix(n_in, n_out=N_MFCC):
+    """Orthonormal DCT-II basis, of shape (n_in, n_out)."""
+    k = np.arange(n_out)[None, :]
+    n = np.arange(n_in)[:, None]
+    basis = np.cos(np.pi * k * (2 * n + 1) / (2. * n_in)) * np.sqrt(2. / n_in)
+    basis[:, 0] /= np.sqrt(2.)
+    return basis
+
+
+def frame_signal(snd_data, frame_length, frame_step):
+    """Split signal into overlapping frames (one per row)."""
+    if len(snd_data) < frame_length:
+        snd_data = np.hstack([snd_data,
+                              np.zeros(frame_length - len(snd_data))])
+    n_frames = 1 + (len(snd_data) - frame_length) // frame_step
+    idx = (np.arange(frame_length)[None, :] +
+           frame_step * np.arange(n_frames)[:, None])
+    return snd_data[idx]
+
+
+class FeatureExtractor(object):
+    """Computes MFCC features for a given sampling rate.
+
+    Frames whose energy is far below the loudest frame (e.g. the silence
+    added around utterances) are dropped. Mel energies are floored
+    relative to their maximum, which limits the weight of background noise
+    in quiet bands. The first coefficient (overall level) is dropped so
+    that features do not depend on the recording gain.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.frame_length = int(round(FRAME_LENGTH * rate))
+        self.frame_step = int(round(FRAME_STEP * rate))
+        self.n_fft = int(2 ** np.ceil(np.log2(self.frame_length)))
+        self.window = np.hamming(self.frame_length)
+        self.filterbank = mel_filterbank(rate, self.n_fft)
+        self.dct = dct_matrix(N_MEL)
+
+    def __call__(self, snd_data):
+        snd_data = snd_data.astype(np.float64)
+        emphasized = np.append(
+            snd_data[:1], snd_data[1:] - PRE_EMPHASIS * snd_data[:-1])
+        frames = frame_signal(emphasized, self.frame_length, self.frame_step)
+        frames *= self.window
+        power = np.abs(np.fft.rfft(frames, self.n_fft)) ** 2 / self.n_fft
+        energy = power.sum(axis=1)
+        power = power[energy >= ENERGY_RATIO * energy.max()]
+        mel = np.dot(power, self.filterbank.T)
+        mel = np.log(np.maximum(mel, LOG_FLOOR * mel.max() + 1e-10))
+        return np.dot(mel, self.dct)[:, 1:]
+
+
+def dtw_distance(template, x):
+    """Subsequence dynamic time warping distance of template in x.
+
+    The whole template is aligned to the best matching part of x: start
+    and end are free on x. Local cost is the euclidean distance between
+    frames; the total cost is normalized by the template length. Each row
+    (template frame) of the accumulated cost is computed at once: steps
+    along x are obtained as a running minimum over the cumulated local
+    costs.
+    """
+    cost = np.sqrt(((template[:, None, :] - x[None, :, :]) ** 2).sum(axis=2))
+    acc = cost[0]
+    for c in cost[1:]:
+        diag_or_up = c + np.minimum(acc, np.hstack([[np.inf], acc[:-1]]))
+        cum = np.cumsum(c)
+        acc = np.minimum.accumulate(diag_or_up - cum) + cum
+    return acc.min() / len(template)
+
+
+def read_wav(path):
+    """Returns samples and sampling rate of a mono 16 bits wav file."""
+    wf = wave.open(path, 'rb')
+    try:
+        if wf.getnchannels() != 1 or wf.getsampwidth() != 2:
+            raise ValueError('{} is not a mono 16 bits wav file.'.format(path))
+        rate = wf.getframerate()
+        data = np.frombuffer(wf.readframes(wf.getnframes()),
+                             dtype=BUFFER_NP_TYPE)
+    finally:
+        wf.close()
+    return data, rate
+
+
+class KeywordFilter(object):
+    """Local keyword matching used to gate cloud recognition.
+
+    Utterances are compared, with DTW on MFCC features, to enrolled
+    recordings of each keyword.
+
+    :param rate: int
+        Sampling rate of the utterances.
+    :param reject_distance: float
+        Utterances farther than this from every template are rejected.
+    :param accept_distance: float
+        Utterances closer than this to a template are a strong match.
+    """
+
+    def __init__(self, rate, reject_distance, accept_distance):
+        self.rate = rate
+        self.reject_distance = reject_distance
+        self.accept_distance = accept_distance
+        # Fails early on unsupported rates
+        self._extractors = {rate: FeatureExtractor(rate)}
+        self.templates = []  # list of (keyword, features)
+
+    def features(self, snd_data, rate=None):
+        rate = self.rate if rate is None else rate
+        if rate not in self._extractors:
+            self._extractors[rate] = FeatureExtractor(rate)
+        return self._extractors[rate](snd_data)
+
+    def enroll(self, keyword, snd_data, rate=None):
+        self.templates.append((keyword, self.features(snd_data, rate=rate)))
+
+    def enroll_directory(self, directory):
+        """Enrolls all wav files from directory.
+
+        The keyword is the file name without numeric suffix, e.g.
+        'screwdriver_2.wav' is a template for 'screwdriver' and
+        'pick_up.wav' for 'pick_up'.
+        Returns the list of (path, error) for the files that were skipped.
+        """
+        skipped = []
+        for name in sorted(os.listdir(directory)):
+            base, ext = os.path.splitext(name)
+            if ext.lower() != '.wav':
+                continue
+            path = os.path.join(directory, name)
+            parts = base.rsplit('_', 1)
+            if len(parts) == 2 and parts[1].isdigit():
+                base = parts[0]
+            try:
+                data, rate = read_wav(path)
+                self.enroll(base, data, rate=rate)
+            except (ValueError, EOFError, wave.Error) as e:
+                skipped.append((path, e))
+        return skipped
+
+    @property
+    def keywords(self):
+        return sorted(set(k for k, _ in self.templates))
+
+    def match(self, snd_data):
+        """Returns closest keyword and its distance.
+
+        Returns (None, inf) when no template is enrolled.
+        """
+        feats = self.features(snd_data)
+        best = (None, np.inf)
+        for keyword, template in self.templates:
+            d = dtw_distance(template, feats)
+            if d < best[1]:
+                best = (keyword, d)
+        return best
+
+    def is_rejected(self, distance):
+        return distance > self.reject_distance
+
+    def is_accepted(self, distance):
+        return distance <= self.accept_distance
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+import random
+from collections import deque
+
+import numpy as np
+
+
+# gRPC status codes on which recognition requests are sent again; gax
+# raises RetryError for the other (permanent) codes, e.g. INVALID_ARGUMENT
+# when the audio is too long.
+TRANSIENT_STATUS_CODES = {
+    'DEADLINE_EXCEEDED': 4,
+    'RESOURCE_EXHAUSTED': 8,
+    'INTERNAL': 13,
+    'UNAVAILABLE': 14,
+}
+
+
+def is_transient_code(code):
+    """Whether a gRPC status code (grpc.StatusCode or int) is transient."""
+    name = getattr(code, 'name', None)
+    if name is not None:
+        return name in TRANSIENT_STATUS_CODES
+    return code in TRANSIENT_STATUS_CODES.values()
+
+
+def is_transient_error(error):
+    """Whether a request error (e.g. gax errors) is worth retrying.
+
+    Transport errors (IOError) are transient; for other errors the gRPC
+    status code of their cause decides.
+    """
+    if isinstance(error, IOError):
+        return True
+    code = getattr(getattr(error, 'cause', None), 'code', None)
+    if callable(code):
+        code = code()
+    return code is not None and is_transient_code(code)
+
+
+
+class LatencyStats(object):
+    """Keeps track of the most recent latencies (in seconds)."""
+
+    def __init__(self, maxlen=100):
+        self._latencies = deque([], maxlen=maxlen)
+
+    def __len__(self):
+        return len(self._latencies)
+
+    def add(self, latency):
+        self._latencies.append(latency)
+
+    def percentile(self, p):
+        if len(self._latencies) == 0:
+            return None
+        return np.percentile(list(self._latencies), p)
+
+    @property
+    def mean(self):
+        if len(self._latencies) == 0:
+            return None
+        return sum(self._latencies) * 1. / len(self._latencies)
+
+
+class PendingRecognition(object):
+    """Recognition of an utterance, possibly spanning several requests.
+
+    :param now: float
+        Time (in seconds) at which the utterance is first submitted.
+    """
+
+    def __init__(self, utterance_id, start_time, end_time, now):
+        self.utterance_id = utterance_id
+        self.start_time = start_time
+        self.end_time = end_time
+        self.created = now
+        self.operations = []  # list of [operation, submission time, is_hedge]
+        self.n_retries = 0
+        self.next_retry = None  # time of next submission when scheduled
+        self.hedged = False
+        self.failed = False  # an operation failed for good, e.g. no speech
+
+    def add_operation(self, operation, now, hedge=False):
+        self.operations.append([operation, now, hedge])
+        if hedge:
+            self.hedged = True
+
+
+class RequestPolicy(object):
+    """Deadline, retry and hedging policy for recognition requests.
+
+    Hedging: when the only request for an utterance has been running for
+    longer than the given percentile of the observed latencies, a duplicate
+    request is sent and the first answer is used.
+
+    :param deadline: float
+        Time (in seconds) after which an utterance is considered failed,
+        None for no deadline.
+    :param max_retries: int
+        Number of additional requests on transient errors.
+    :param backoff: float
+        Base delay (in seconds) before retrying, doubled at each retry.
+    :param max_backoff: float
+        Maximum delay before retrying.
+    :param hedge: bool
+        Whether to send hedged requests.
+    :param hedge_percentile: float
+        Percentile of the latencies after which to hedge.
+    :param hedge_min_samples: int
+        Number of observed latencies required before hedging.
+    """
+
+    def __init__(self, deadline=None, max_retries=2, backoff=.5,
+                 max_backoff=8., hedge=False, hedge_percentile=95,
+                 hedge_min_samples=10):
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.request_latencies = LatencyStats()
+        self.latencies = LatencyStats()
+        self.hedged_latencies = LatencyStats()
+        self.n_utterances = 0
+        self.n_retries = 0
+        self.n_hedges = 0
+        self.n_hedge_wins = 0
+        self.n_failures = 0
+        self.n_timeouts = 0
+
+    def can_retry(self, n_retries):
+        return n_retries < self.max_retries
+
+    def retry_delay(self, n_retries):
+        """Exponential backoff with full jitter."""
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** n_retries))
+
+    def schedule_retry(self, pending, now):
+        """Returns False if no retry is left for pending."""
+        if not self.can_retry(pending.n_retries):
+            return False
+        pending.next_retry = now + self.retry_delay(pending.n_retries)
+        pending.n_retries += 1
+        self.record_retry()
+        return True
+
+    def is_expired(self, pending, now):
+        return self.deadline is not None and now - pending.created > self.deadline
+
+    @property
+    def hedge_delay(self):
+        if len(self.request_latencies) < self.hedge_min_samples:
+            return None
+        return self.request_latencies.percentile(self.hedge_percentile)
+
+    def should_hedge(self, pending, now):
+        if not self.hedge or pending.hedged or len(pending.operations) != 1:
+            return False
+        delay = self.hedge_delay
+        return delay is not None and now - pending.operations[0][1] > delay
+
+    def record_submission(self, hedge=False):
+        if hedge:
+            self.n_hedges += 1
+        else:
+            self.n_utterances += 1
+
+    def record_retry(self):
+        self.n_retries += 1
+
+    def record_success(self, pending, submitted, hedge, now):
+        # Only original requests define the hedging delay
+        if hedge:
+            self.n_hedge_wins += 1
+            # The original request is still running: record a lower bound of
+            # its latency so that slow requests are not left out of the tail.
+            for _, original_submitted, is_hedge in pending.operations:
+                if not is_hedge:
+                    self.request_latencies.add(now - original_submitted)
+        else:
+            self.request_latencies.add(now - submitted)
+        self.latencies.add(now - pending.created)
+        if pending.hedged:
+            self.hedged_latencies.add(now - pending.created)
+
+    def record_failure(self, timeout=False):
+        self.n_failures += 1
+        if timeout:
+            self.n_timeouts += 1
+
+    def report(self):
+        def rate(n, total):
+            return n * 1. / total if total > 0 else 0.
+
+        def fmt(latency):
+            return 'n/a' if latency is None else '{:.2f}s'.format(latency)
+
+        return ('{} utterances, {} retries, {} failures ({} timeouts); '
+                'hedge rate: {:.2f}, hedge win rate: {:.2f}; '
+                'latency mean/p95: {}/{}, hedged: {}/{}').format(
+            self.n_utterances, self.n_retries, self.n_failures,
+            self.n_timeouts,
+            rate(self.n_hedges, self.n_utterances),
+            rate(self.n_hedge_wins, self.n_hedges),
+            fmt(self.latencies.mean), fmt(self.latencies.percentile(95)),
+            fmt(self.hedged_latencies.mean),
+            fmt(self.hedged_latencies.percentile(95)))
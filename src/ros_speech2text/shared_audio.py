@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+import mmap
+import os
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+import rospy
+
+from .speech_detection import BUFFER_NP_TYPE
+
+
+HEADER_NP_TYPE = '<u8'
+HEADER_SIZE = 2  # capacity, write position
+HEADER_BYTES = HEADER_SIZE * np.dtype(HEADER_NP_TYPE).itemsize
+
+
+UtteranceAudioDescriptor = namedtuple(
+    'UtteranceAudioDescriptor',
+    ['utterance_id', 'shm_path', 'position', 'offset', 'length',
+     'sample_rate', 'start_time', 'end_time'])
+
+
+class AudioRing(object):
+    """Ring buffer of samples in a memory mapped file.
+
+    Samples are addressed by their absolute position, i.e. the number of
+    samples written before them. Each chunk is kept contiguous in memory:
+    when it does not fit before the end of the buffer it is written at
+    the start and the write position skips to the next lap. The write
+    position is updated before the samples are copied, hence data read
+    at a position is complete if that position is still valid after
+    reading.
+
+    :param path: str
+        File backing the buffer, typically in /dev/shm.
+    :param capacity: int
+        Number of samples, required when creating the buffer.
+    """
+
+    def __init__(self, path, capacity=None, create=False):
+        self.path = path
+        if create:
+            size = HEADER_BYTES + capacity * np.dtype(BUFFER_NP_TYPE).itemsize
+            with open(path, 'w+b') as f:
+                f.truncate(size)
+                self._mmap = mmap.mmap(f.fileno(), size)
+        else:
+            with open(path, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._header = np.frombuffer(self._mmap, dtype=HEADER_NP_TYPE,
+                                     count=HEADER_SIZE)
+        if create:
+            self._header[:] = [capacity, 0]
+        self.capacity = int(self._header[0])
+        self._data = np.frombuffer(self._mmap, dtype=BUFFER_NP_TYPE,
+                                   count=self.capacity, offset=HEADER_BYTES)
+
+    @property
+    def write_position(self):
+        return int(self._header[1])
+
+    def offset(self, position):
+        return position % self.capacity
+
+    def write(self, samples):
+        """Appends samples and returns their position."""
+        length = len(samples)
+        if length > self.capacity:
+            raise ValueError('Cannot store {} samples in a buffer of {}.'
+                             .format(length, self.capacity))
+        position = self.write_position
+        if self.offset(position) + length > self.capacity:
+            position += self.capacity - self.offset(position)
+        self._header[1] = position + length
+        offset = self.offset(position)
+        self._data[offset:offset + length] = samples
+        return position
+
+    def is_valid(self, position, length):
+        return (position + length <= self.write_position <=
+                position + self.capacity)
+
+    def view(self, position, length):
+        """Returns samples without copy.
+
+        The returned array is overwritten once the buffer has wrapped around;
+        use is_valid to check that it is still current.
+        """
+        if not self.is_valid(position, length):
+            raise ValueError('Samples at {} have been overwritten.'.format(
+                position))
+        offset = self.offset(position)
+        return self._data[offset:offset + length]
+
+    def close(self):
+        """Releases the buffer.
+
+        The memory is not unmapped explicitly (this would invalidate views
+        still held by consumers) but once the last view is released.
+        """
+        self._header = None
+        self._data = None
+        self._mmap = None
+
+
+class UtteranceAudioIndex(object):
+    """Access to recent utterance audio from their descriptors."""
+
+    def __init__(self, max_utterances=100):
+        self.max_utterances = max_utterances
+        self._descriptors = OrderedDict()
+
+    def ring(self, descriptor):
+        raise NotImplementedError
+
+    def add_descriptor(self, descriptor):
+        """Registers descriptor (UtteranceAudioDescriptor or message)."""
+        self._descriptors[descriptor.utterance_id] = descriptor
+        while len(self._descriptors) > self.max_utterances:
+            self._descriptors.popitem(last=False)
+
+    def descriptor(self, utterance_id):
+        return self._descriptors.get(utterance_id, None)
+
+    def is_available(self, utterance_id):
+        d = self.descriptor(utterance_id)
+        if d is None:
+            return False
+        try:
+            ring = self.ring(d)
+        except (IOError, OSError):  # e.g. the node removed the buffer
+            return False
+        return ring.is_valid(d.position, d.length)
+
+    def get(self, utterance_id):
+        """Samples of utterance as a view on the shared memory (no copy).
+
+        Returns None if the utterance is unknown or has been overwritten.
+        """
+        if not self.is_available(utterance_id):
+            return None
+        d = self.descriptor(utterance_id)
+        return self.ring(d).view(d.position, d.length)
+
+
+class SharedUtteranceAudio(UtteranceAudioIndex):
+    """Writes utterance audio to shared memory.
+
+    In-process consumers can register listeners, that are called with the
+    descriptor and a view on the samples for each new utterance.
+    Other processes use an UtteranceAudioReader.
+
+    :param seconds: float
+        Duration of audio that the buffer holds.
+    """
+
+    def __init__(self, path, rate, seconds=60., max_utterances=100):
+        super(SharedUtteranceAudio, self).__init__(
+            max_utterances=max_utterances)
+        self.rate = rate
+        self._ring = AudioRing(path, capacity=int(seconds * rate),
+                               create=True)
+        self._listeners = []
+
+    def ring(self, descriptor):
+        return self._ring
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def add(self, utterance_id, samples, start_time, end_time):
+        position = self._ring.write(samples)
+        descriptor = UtteranceAudioDescriptor(
+            utterance_id, self._ring.path, position,
+            self._ring.offset(position), len(samples), self.rate,
+            start_time, end_time)
+        self.add_descriptor(descriptor)
+        view = self.get(utterance_id)
+        for callback in self._listeners:
+            try:
+                callback(descriptor, view)
+            except Exception as e:
+                # A faulty consumer should not stop audio capture
+                rospy.logerr("Error in utterance audio listener: {}".format(e))
+        return descriptor
+
+    def close(self, remove=True):
+        self._ring.close()
+        if remove:
+            os.remove(self._ring.path)
+
+
+class UtteranceAudioReader(UtteranceAudioIndex):
+    """Reads utterance audio shared by another process.
+
+    Descriptors, e.g. received as messages, are registered with
+    add_descriptor, which can directly be used as a subscriber callback.
+    """
+
+    def __init__(self, max_utterances=100):
+        super(UtteranceAudioReader, self).__init__(
+            max_utterances=max_utterances)
+        self._rings = {}
+
+    def ring(self, descriptor):
+        if descriptor.shm_path not in self._rings:
+            self._rings[descriptor.shm_path] = AudioRing(descriptor.shm_path)
+        return self._rings[descriptor.shm_path]
+
+    def close(self):
+        for ring in self._rings.values():
+            ring.close()
+        self._rings = {}
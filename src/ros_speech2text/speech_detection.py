@@ -114,15 +114,25 @@ class SpeechDetector:
         has volume that is too low, we increase num_silent. When num_silent
         exceeds ten, we consider the sentence finished.
 
+    Self-speech gating:
+        While the robot is speaking (see set_robot_speaking), no utterance
+        is started and the average volume is frozen so that the robot's
+        voice neither triggers recognition nor raises the dynamic
+        threshold. Gating is kept for self_speech_guard seconds after the
+        robot stops speaking. Bursts that would have started an utterance are
+        counted in n_skipped_triggers.
+
     :param threshold: float
         Static or dynamic threshold. Interpreted as a percentage when dynamic.
     :param n_silent: int
         Number of silent chunks to end detected utterance.
+    :param self_speech_guard: float
+        Duration (in seconds) still gated after the robot stops speaking.
     """
 
     def __init__(self, rate, threshold, dynamic_threshold=False,
                  dynamic_threshold_frame=3, chunk_size=None,
-                 min_average_volume=0., n_silent=10):
+                 min_average_volume=0., n_silent=10, self_speech_guard=.5):
         self.rate = rate
         if dynamic_threshold:
             self.silence_detect = DynamicSilenceDetector(
@@ -134,6 +144,12 @@ class SpeechDetector:
         self.chunk_size = chunk_size
         self.dyn_thr_frame = dynamic_threshold_frame
         self.max_n_silent = n_silent
+        self.guard_chunks = int(np.ceil(
+            self_speech_guard * self.rate / self.chunk_size))
+        self.robot_speaking = False
+        self.n_skipped_triggers = 0
+        self._guard_left = 0
+        self._n_gated_peaks = 0
         self.reset()
 
     def reset(self):
@@ -144,8 +160,42 @@ class SpeechDetector:
         self.in_utterance = False
         self.start_time = None
 
+    def set_robot_speaking(self, speaking):
+        if speaking:
+            self.robot_speaking = True
+        elif self.robot_speaking:
+            # Called from the subscriber thread: set the guard first so that
+            # the detector stays gated in between.
+            self._guard_left = self.guard_chunks
+            self.robot_speaking = False
+
+    @property
+    def is_gated(self):
+        return self.robot_speaking or self._guard_left > 0
+
+    def treat_gated_chunk(self, silent):
+        """Drop chunk received while the robot is (or just was) speaking."""
+        self.chunks = []
+        self.n_peaks = 0
+        if silent:
+            self._n_gated_peaks = 0
+        else:
+            self._n_gated_peaks += 1
+            if self._n_gated_peaks == (1 if self.silence_detect.is_static
+                                       else self.dyn_thr_frame):
+                self.n_skipped_triggers += 1
+                rospy.logdebug('skipped trigger while robot is speaking '
+                               '(total: {})'.format(self.n_skipped_triggers))
+        if not self.robot_speaking and self._guard_left > 0:
+            self._guard_left -= 1
+        if not self.is_gated:
+            self._n_gated_peaks = 0
+
     def treat_chunk(self, chunk):
         silent = self.silence_detect.is_silent(chunk)
+        if not self.in_utterance and self.is_gated:
+            self.treat_gated_chunk(silent)
+            return
         # Print average for dynamic threshold
         # TODO: should be a debug
         if not self.silence_detect.is_static:
@@ -156,7 +206,9 @@ class SpeechDetector:
             if not self.silence_detect.is_static:  # TODO: Why only for dynamic?
                 self.n_peaks += 1
                 self.silence_detect.update_average(chunk)
-                self.chunks.append(chunk)
+                if self.n_peaks < self.dyn_thr_frame:
+                    # Last peak is added with the utterance below
+                    self.chunks.append(chunk)
             if (self.silence_detect.is_static or
                     self.n_peaks >= self.dyn_thr_frame):
                 rospy.logdebug('collecting audio segment')
@@ -173,6 +225,11 @@ class SpeechDetector:
             else:
                 self.n_silent = 0
 
+    @property
+    def raw_utterance(self):
+        """Captured chunks of the last utterance, without processing."""
+        return np.hstack(self.chunks)
+
     @property
     def found(self):
         return self.n_silent > self.max_n_silent
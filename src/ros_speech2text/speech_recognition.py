@@ -10,16 +10,21 @@ from threading import Thread
 import wave
 import pyaudio
 from google.cloud import speech
-from google.gax.errors import RetryError
+from google.gax.errors import GaxError
 
 import rospy
-from std_msgs.msg import String, Header
-from ros_speech2text.msg import transcript, event
+from std_msgs.msg import String, Header, Bool
+from ros_speech2text.msg import transcript, event, utterance_audio
 
 from .speech_detection import SpeechDetector
+from .keyword_filter import KeywordFilter
+from .recognition_policy import (PendingRecognition, RequestPolicy,
+                                 is_transient_code, is_transient_error)
+from .shared_audio import SharedUtteranceAudio
 
 
 FORMAT = pyaudio.paInt16
+REQUEST_ERRORS = (GaxError, IOError)
 
 
 def list_audio_devices(pyaudio_handler):
@@ -38,7 +43,12 @@ class SpeechRecognizer(object):
     class InvalidDevice(ValueError):
         pass
 
-    def __init__(self):
+    def __init__(self, audio_listeners=()):
+        """
+        :param audio_listeners: iterable
+            Callbacks called, in this process, with the descriptor and
+            samples of each utterance (see SharedUtteranceAudio).
+        """
         self._init_history_directory()
         self.node_name = rospy.get_name()
         self.print_level = rospy.get_param('/print_level', 0)
@@ -69,13 +79,35 @@ class SpeechRecognizer(object):
                 self.node_name + '/audio_min_avg', 100),
             n_silent=rospy.get_param(
                 self.node_name + '/n_silent_chunks', 10),
+            self_speech_guard=rospy.get_param(
+                self.node_name + '/self_speech_guard', .5),
         )
+        robot_speaking_topic = rospy.get_param(
+            self.node_name + '/robot_speaking_topic', None)
+        if robot_speaking_topic is not None:
+            rospy.Subscriber(robot_speaking_topic, Bool,
+                             self._robot_speaking_cb)
+        self._init_keyword_filter()
+        self.policy = RequestPolicy(
+            deadline=rospy.get_param(
+                self.node_name + '/recognition_deadline', None),
+            max_retries=rospy.get_param(
+                self.node_name + '/recognition_max_retries', 2),
+            backoff=rospy.get_param(
+                self.node_name + '/recognition_backoff', .5),
+            hedge=rospy.get_param(self.node_name + '/enable_hedging', False),
+            hedge_percentile=rospy.get_param(
+                self.node_name + '/hedge_percentile', 95),
+        )
+        self.poll_period = rospy.get_param(
+            self.node_name + '/operation_poll_period', 1.)
         rospy.loginfo('Print level: {}'.format(self.print_level))
         if self.print_level > 0:
             rospy.loginfo('Sample Rate: {}'.format(self.sample_rate))
 
         self._init_stream()
         self._init_csv()
+        self._init_shared_audio(audio_listeners)
         self.speech_client = speech.Client()
         self.run()
 
@@ -86,6 +118,38 @@ class SpeechRecognizer(object):
         if not os.path.isdir(self.history_dir):
             os.makedirs(self.history_dir)
 
+    def _init_keyword_filter(self):
+        self.keyword_filter = None
+        self.n_filtered = 0
+        templates_dir = rospy.get_param(
+            self.node_name + '/keyword_templates_dir', None)
+        if templates_dir is None:
+            return
+        templates_dir = os.path.expanduser(templates_dir)
+        if not os.path.isdir(templates_dir):
+            rospy.logwarn('Keyword templates directory not found: {}. '
+                          'Keyword filter disabled.'.format(templates_dir))
+            return
+        try:
+            self.keyword_filter = KeywordFilter(
+                self.sample_rate,
+                rospy.get_param(self.node_name + '/keyword_reject_distance', 9.),
+                rospy.get_param(self.node_name + '/keyword_accept_distance', 3.))
+        except ValueError:
+            self.terminate()
+            raise
+        for path, e in self.keyword_filter.enroll_directory(templates_dir):
+            rospy.logwarn('Skipping keyword template {}: {}'.format(path, e))
+        if not self.keyword_filter.templates:
+            rospy.logwarn('No keyword template in {}. Keyword filter '
+                          'disabled.'.format(templates_dir))
+            self.keyword_filter = None
+            return
+        rospy.loginfo('Keyword filter templates: {}'.format(
+            ', '.join(self.keyword_filter.keywords)))
+        self.pub_keyword = rospy.Publisher(
+            self.TOPIC_BASE + '/keyword', String, queue_size=10)
+
     def _init_stream(self):
         self.pa_handler = pyaudio.PyAudio()
         device_list = list_audio_devices(self.pa_handler)
@@ -119,6 +183,21 @@ class SpeechRecognizer(object):
                 '/ros_speech2text/available_audio_device'.format(input_idx))
         self.sample_width = self.pa_handler.get_sample_size(FORMAT)
 
+    def _init_shared_audio(self, listeners):
+        self.shared_audio = None
+        if not rospy.get_param(self.node_name + '/share_audio', False):
+            return
+        shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else self.history_dir
+        self.shared_audio = SharedUtteranceAudio(
+            os.path.join(shm_dir, 'ros_speech2text_{}'.format(os.getpid())),
+            self.sample_rate,
+            seconds=rospy.get_param(
+                self.node_name + '/shared_audio_seconds', 60.))
+        for callback in listeners:
+            self.shared_audio.add_listener(callback)
+        self.pub_audio = rospy.Publisher(
+            self.TOPIC_BASE + '/audio', utterance_audio, queue_size=10)
+
     def _init_csv(self):
         self.csv_file = open(os.path.join(self.history_dir, 'transcript'), 'wb')
         self.csv_writer = csv.writer(self.csv_file, delimiter=' ',)
@@ -137,21 +216,91 @@ class SpeechRecognizer(object):
                 rospy.loginfo("No more data, exiting...")
                 break
             self.record_to_file(aud_data, sn)
+            if self.shared_audio is not None:
+                self.share_audio(self.speech_detector.raw_utterance, sn,
+                                 start_time, end_time)
+            if (self.keyword_filter is not None and
+                    not self.prefilter(aud_data, sn, start_time, end_time)):
+                sn += 1
+                continue
             if self.async:
-                operation = self.recog(sn)
-                if operation is not None:  # TODO: Improve
-                    self.operation_queue.append([sn, operation, start_time, end_time])
+                pending = PendingRecognition(sn, start_time, end_time,
+                                             rospy.get_time())
+                self.policy.record_submission()
+                if self.submit(pending):
+                    self.operation_queue.append(pending)
+                else:
+                    self.recognition_failed(pending)
             else:
                 # Send only that you received speech if you don't want transcriptions.
                 if not self.do_transcription:
-                    transc, confidence = ("dummy_transcript with no confidence", 0.0)
+                    result = ("dummy_transcript with no confidence", 0.0)
+                else:
+                    self.policy.record_submission()
+                    result = self.recog_with_retries(sn)
+                if result is None:
+                    self.policy.record_failure()
+                    self.utterance_failed(sn, start_time, end_time)
                 else:
-                    transc, confidence = self.recog(sn)
-                self.utterance_decoded(sn, transc, confidence, start_time, end_time)
+                    transc, confidence = result
+                    self.utterance_decoded(sn, transc, confidence, start_time, end_time)
             sn += 1
         self.terminate()
 
+    def prefilter(self, aud_data, utterance_id, start_time, end_time):
+        """
+        Matches the utterance against local keyword templates.
+        Strong matches are published right away on the keyword topic.
+        Returns False if the utterance matches no keyword and should not be
+        sent for recognition.
+        """
+        keyword, distance = self.keyword_filter.match(aud_data)
+        rospy.logdebug('Closest keyword: {} (distance: {})'.format(
+            keyword, distance))
+        if self.keyword_filter.is_rejected(distance):
+            self.n_filtered += 1
+            self.utterance_failed(utterance_id, start_time, end_time)
+            return False
+        if self.keyword_filter.is_accepted(distance):
+            self.pub_keyword.publish(keyword)
+        return True
+
+    def share_audio(self, aud_data, utterance_id, start_time, end_time):
+        """Writes utterance to shared memory and publishes its descriptor."""
+        try:
+            d = self.shared_audio.add(utterance_id, aud_data, start_time,
+                                      end_time)
+        except ValueError as e:
+            rospy.logwarn("Utterance not shared: {}".format(e))
+            return
+        msg = utterance_audio()
+        msg.header = Header()
+        msg.header.stamp = rospy.Time.now()
+        msg.utterance_id = d.utterance_id
+        msg.shm_path = d.shm_path
+        msg.position = d.position
+        msg.offset = d.offset
+        msg.length = d.length
+        msg.sample_rate = d.sample_rate
+        msg.start_time = d.start_time
+        msg.end_time = d.end_time
+        self.pub_audio.publish(msg)
+
+    def _robot_speaking_cb(self, msg):
+        self.speech_detector.set_robot_speaking(msg.data)
+
     def terminate(self):
+        if hasattr(self, "speech_detector"):
+            rospy.loginfo('Triggers skipped while robot was speaking: {}'.format(
+                self.speech_detector.n_skipped_triggers))
+        if getattr(self, "keyword_filter", None) is not None:
+            rospy.loginfo('Utterances dropped by keyword filter: {}'.format(
+                self.n_filtered))
+        if hasattr(self, "policy"):
+            rospy.loginfo('Recognition requests: {}'.format(
+                self.policy.report()))
+        if getattr(self, "shared_audio", None) is not None:
+            self.shared_audio.close()
         if hasattr(self, "stream"):
             self.stream.close()
         if hasattr(self, "pa_handler"):
@@ -259,19 +408,125 @@ class SpeechRecognizer(object):
                 sample_rate=self.sample_rate)
 
         if self.async:
-            try:
-                operation = self.speech_client.speech_api.async_recognize(
-                    sample=audio_sample, speech_context=context)
-                return operation
-            except (ValueError, RetryError) as e:
-                rospy.logerr(e)
-                rospy.logerr("Audio Segment too long. Unable to recognize")
+            return self.speech_client.speech_api.async_recognize(
+                sample=audio_sample, speech_context=context)
         else:
             alternatives = self.speech_client.speech_api.sync_recognize(
                 sample=audio_sample, speech_context=context)
             for alternative in alternatives:
                 return alternative.transcript, alternative.confidence
 
+    def recog_with_retries(self, utterance_id):
+        """
+        Synchronous recog, retried with backoff on transient errors.
+        Returns None if the utterance could not be recognized.
+        """
+        n_retries = 0
+        while True:
+            try:
+                return self.recog(utterance_id)
+            except REQUEST_ERRORS as e:
+                if (not is_transient_error(e) or
+                        not self.policy.can_retry(n_retries) or
+                        rospy.is_shutdown()):
+                    rospy.logerr("Unable to recognize: {}".format(e))
+                    return None
+                rospy.logwarn("Recognition request failed, retrying: {}".format(e))
+                rospy.sleep(self.policy.retry_delay(n_retries))
+                n_retries += 1
+                self.policy.record_retry()
+
+    def submit(self, pending, hedge=False, now=None):
+        """
+        Sends a new recog operation for the pending utterance.
+        Returns False if the utterance cannot be recognized.
+        """
+        if now is None:
+            now = rospy.get_time()
+        if hedge:
+            pending.hedged = True  # Only one hedge attempt, even on error
+        try:
+            operation = self.recog(pending.utterance_id)
+        except REQUEST_ERRORS as e:
+            if not is_transient_error(e):
+                rospy.logerr(e)
+                rospy.logerr("Unable to recognize")
+                return hedge
+            rospy.logwarn("Recognition request failed: {}".format(e))
+            return hedge or self.policy.schedule_retry(pending, now)
+        except ValueError as e:
+            rospy.logerr(e)
+            rospy.logerr("Audio Segment too long. Unable to recognize")
+            return hedge
+        pending.add_operation(operation, now, hedge=hedge)
+        if hedge:
+            self.policy.record_submission(hedge=True)
+            rospy.logdebug('Hedged request for utterance {}'.format(
+                pending.utterance_id))
+        return True
+
+    def recognition_failed(self, pending, timeout=False):
+        self.policy.record_failure(timeout=timeout)
+        self.utterance_failed(pending.utterance_id, pending.start_time,
+                              pending.end_time)
+
+    def check_pending(self, pending, now=None):
+        """
+        Polls the operations of a pending utterance, retrying or hedging
+        according to the request policy.
+        Returns True once the utterance is decoded or has failed.
+        """
+        if now is None:
+            now = rospy.get_time()
+        for op in pending.operations[:]:
+            operation, submitted, hedge = op
+            if operation.complete:
+                if operation.results is not None:
+                    self.policy.record_success(pending, submitted, hedge, now)
+                    for result in operation.results:
+                        self.utterance_decoded(
+                            pending.utterance_id, result.transcript,
+                            result.confidence, pending.start_time,
+                            pending.end_time)
+                    return True
+                pending.operations.remove(op)
+                error = getattr(operation, 'error', None)
+                if error is None or not is_transient_code(error.code):
+                    pending.failed = True  # e.g. no speech
+                continue
+            try:
+                operation.poll()
+            except ValueError:  # Operation completed without results
+                pending.operations.remove(op)
+                pending.failed = True
+            except REQUEST_ERRORS as e:
+                if is_transient_error(e):
+                    # The operation may still be running: poll again later
+                    rospy.logwarn("Polling recognition failed: {}".format(e))
+                else:
+                    rospy.logerr("Recognition failed: {}".format(e))
+                    pending.operations.remove(op)
+                    pending.failed = True
+        if self.policy.is_expired(pending, now):
+            self.recognition_failed(pending, timeout=True)
+            return True
+        if not pending.operations:
+            if pending.failed:
+                self.recognition_failed(pending)
+                return True
+            if (pending.next_retry is None and
+                    not self.policy.schedule_retry(pending, now)):
+                self.recognition_failed(pending)
+                return True
+            if now >= pending.next_retry:
+                pending.next_retry = None
+                if not self.submit(pending, now=now):
+                    self.recognition_failed(pending)
+                    return True
+        elif self.policy.should_hedge(pending, now):
+            self.submit(pending, hedge=True, now=now)
+        return False
+
     def check_operation(self):
         """
         This function is intended to be run as a seperate thread that repeatedly
@@ -281,21 +536,10 @@ class SpeechRecognizer(object):
         """
         while not rospy.is_shutdown():
             try:
-                for op in self.operation_queue[:]:
-                    utterance_id, operation, start_time, end_time = op
-                    if operation.complete and operation.results is not None:
-                        for result in operation.results:
-                            self.utterance_decoded(
-                                utterance_id, result.transcript, result.confidence,
-                                start_time, end_time)
-                        self.operation_queue.remove(op)
-                    else:
-                        try:
-                            operation.poll()
-                        except ValueError:
-                            self.utterance_failed(utterance_id, start_time, end_time)
-                            self.operation_queue.remove(op)
+                for pending in self.operation_queue[:]:
+                    if self.check_pending(pending):
+                        self.operation_queue.remove(pending)
             except Exception as e:
                 rospy.logerr("Error in speech recognition thread: {}".format(e))
                 self.operation_queue = []
-            rospy.sleep(1)
+            rospy.sleep(self.poll_period)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+PKG = 'ros_speech2text'
+
+import os
+import shutil
+import tempfile
+import unittest
+import wave
+from struct import pack
+from unittest import TestCase
+
+import numpy as np
+
+from ros_speech2text.keyword_filter import (FeatureExtractor, KeywordFilter,
+                                            dtw_distance, frame_signal,
+                                            read_wav)
+
+
+RATE = 16000
+
+
+def tone(freqs, duration=.3, rate=RATE):
+    """Sequence of pure tones, as 16 bits integers."""
+    t = np.arange(int(duration * rate)) * 1. / rate
+    return np.hstack([(8000 * np.sin(2 * np.pi * f * t)).astype(np.int16)
+                      for f in freqs])
+
+
+def to_frames(data):
+    return pack('<' + ('h' * len(data)), *data)
+
+
+class TestFrameSignal(TestCase):
+    def test_frames(self):
+        frames = frame_signal(np.arange(10), 4, 3)
+        np.testing.assert_array_equal(
+            frames, [[0, 1, 2, 3], [3, 4, 5, 6], [6, 7, 8, 9]])
+
+    def test_short_signal_is_padded(self):
+        frames = frame_signal(np.arange(2), 4, 3)
+        np.testing.assert_array_equal(frames, [[0, 1, 0, 0]])
+
+
+class TestFeatureExtractor(TestCase):
+    def test_shape(self):
+        feats = FeatureExtractor(RATE)(tone([440], duration=1.))
+        self.assertEqual(feats.shape, (98, 12))
+
+    def test_silence_is_trimmed(self):
+        fe = FeatureExtractor(RATE)
+        snd = tone([440], duration=.5)
+        padded = np.hstack([np.zeros(RATE // 2, dtype=np.int16), snd])
+        # Only frames overlapping the start of the tone are kept
+        self.assertLessEqual(len(fe(padded)), len(fe(snd)) + 2)
+
+    def test_gain_invariant(self):
+        fe = FeatureExtractor(RATE)
+        snd = tone([300, 600])
+        np.testing.assert_allclose(fe(snd), fe(snd // 4), atol=1e-2)
+
+
+class TestDTW(TestCase):
+    def test_identical_is_zero(self):
+        x = np.random.random((10, 3))
+        self.assertAlmostEqual(dtw_distance(x, x), 0.)
+
+    def test_warping_is_free(self):
+        x = np.random.random((10, 3))
+        y = np.repeat(x, 2, axis=0)
+        self.assertAlmostEqual(dtw_distance(x, y), 0.)
+
+    def test_subsequence_is_free(self):
+        template = np.random.random((5, 3))
+        x = np.vstack([np.random.random((10, 3)), template,
+                       np.random.random((10, 3))])
+        self.assertAlmostEqual(dtw_distance(template, x), 0.)
+
+    def test_matches_naive_implementation(self):
+        template = np.random.random((5, 3))
+        x = np.random.random((7, 3))
+        cost = np.sqrt(
+            ((template[:, None, :] - x[None, :, :]) ** 2).sum(axis=2))
+        acc = np.full((6, 8), np.inf)
+        acc[0, :] = 0.  # Free start on x
+        for i in range(1, 6):
+            for j in range(1, 8):
+                acc[i, j] = cost[i - 1, j - 1] + min(
+                    acc[i - 1, j - 1], acc[i - 1, j], acc[i, j - 1])
+        # Free end on x
+        self.assertAlmostEqual(dtw_distance(template, x),
+                               acc[-1, 1:].min() / 5.)
+
+
+class TestKeywordFilter(TestCase):
+    def setUp(self):
+        self.kf = KeywordFilter(RATE, reject_distance=20.,
+                                accept_distance=5.)
+        self.kf.enroll('up', tone([300, 600, 1200]))
+        self.kf.enroll('down', tone([1200, 600, 300]))
+
+    def test_no_template(self):
+        kf = KeywordFilter(RATE, 1., 1.)
+        self.assertEqual(kf.match(tone([440])), (None, np.inf))
+
+    def test_keywords(self):
+        self.assertEqual(self.kf.keywords, ['down', 'up'])
+
+    def test_match_closest(self):
+        self.assertEqual(self.kf.match(tone([300, 600, 1200], .4))[0], 'up')
+        self.assertEqual(self.kf.match(tone([1200, 600, 300], .2))[0], 'down')
+
+    def test_exact_match_is_accepted(self):
+        _, d = self.kf.match(tone([300, 600, 1200]))
+        self.assertTrue(self.kf.is_accepted(d))
+        self.assertFalse(self.kf.is_rejected(d))
+
+    def test_template_at_other_rate(self):
+        kf = KeywordFilter(RATE, reject_distance=20., accept_distance=5.)
+        kf.enroll('up', tone([300, 600, 1200], rate=8000), rate=8000)
+        kf.enroll('down', tone([1200, 600, 300]))
+        keyword, d = kf.match(tone([300, 600, 1200]))
+        self.assertEqual(keyword, 'up')
+        self.assertTrue(kf.is_accepted(d))
+
+    def test_rate_too_low(self):
+        self.assertRaises(ValueError, self.kf.enroll, 'up',
+                          tone([300], rate=6000), rate=6000)
+        self.assertRaises(ValueError, KeywordFilter, 6000, 1., 1.)
+
+    def test_enroll_directory(self):
+        directory = tempfile.mkdtemp()
+        for name, channels in [('pick_up.wav', 1), ('hammer_0.wav', 1),
+                               ('hammer_1.wav', 1), ('stereo.wav', 2),
+                               ('notes.txt', 1)]:
+            wf = wave.open(os.path.join(directory, name), 'wb')
+            wf.setnchannels(channels)
+            wf.setsampwidth(2)
+            wf.setframerate(RATE)
+            wf.writeframes(to_frames(tone([300, 600])))
+            wf.close()
+        kf = KeywordFilter(RATE, 1., 1.)
+        skipped = kf.enroll_directory(directory)
+        shutil.rmtree(directory)
+        self.assertEqual(kf.keywords, ['hammer', 'pick_up'])
+        self.assertEqual(len(kf.templates), 3)
+        self.assertEqual([os.path.basename(p) for p, _ in skipped],
+                         ['stereo.wav'])
+
+    def test_read_wav_rejects_stereo(self):
+        path = os.path.join(tempfile.mkdtemp(), 'stereo.wav')
+        wf = wave.open(path, 'wb')
+        wf.setnchannels(2)
+        wf.setsampwidth(2)
+        wf.setframerate(RATE)
+        wf.writeframes(to_frames(tone([300])))
+        wf.close()
+        self.assertRaises(ValueError, read_wav, path)
+        shutil.rmtree(os.path.dirname(path))
+
+
+class TestKeywordFilterOnRecordings(TestCase):
+    """Keyword cut from a recorded sentence, against speech and noise."""
+
+    @classmethod
+    def setUpClass(cls):
+        audio_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  'test_audio')
+        cls.sentences = []
+        for i in range(4):
+            data, cls.rate = read_wav(
+                os.path.join(audio_path, 'sentence{}.wav'.format(i)))
+            cls.sentences.append(data)
+        # Default thresholds of the node
+        cls.kf = KeywordFilter(cls.rate, reject_distance=9.,
+                               accept_distance=3.)
+        # 'good morning' in sentence0
+        cls.kf.enroll('greeting', cls.sentences[0][cls.rate:cls.rate * 9 // 5])
+
+    def noise(self, kind):
+        rng = np.random.RandomState(0)
+        n = 2 * self.rate
+        if kind == 'white':
+            x = rng.randn(n)
+        elif kind == 'brown':
+            x = np.cumsum(rng.randn(n))
+            x -= x.mean()
+        elif kind == 'hum':
+            t = np.arange(n) * 1. / self.rate
+            x = np.sin(2 * np.pi * 60 * t) + .3 * np.sin(2 * np.pi * 180 * t)
+        x = (16384 * x / np.abs(x).max()).astype(np.int16)
+        silence = np.zeros((self.rate, ), dtype=np.int16)
+        return np.hstack([silence, x, silence])
+
+    def test_embedded_keyword_is_accepted(self):
+        keyword, d = self.kf.match(self.sentences[0])
+        self.assertEqual(keyword, 'greeting')
+        self.assertTrue(self.kf.is_accepted(d))
+
+    def test_noisy_keyword_is_closest(self):
+        rng = np.random.RandomState(0)
+        noisy = (.3 * self.sentences[0] +
+                 50 * rng.randn(len(self.sentences[0]))).astype(np.int16)
+        _, d = self.kf.match(noisy)
+        self.assertFalse(self.kf.is_rejected(d))
+        self.assertLess(d, min(self.kf.match(s)[1]
+                               for s in self.sentences[1:]))
+
+    def test_other_speech_is_not_rejected(self):
+        for sentence in self.sentences[1:]:
+            _, d = self.kf.match(sentence)
+            self.assertFalse(self.kf.is_rejected(d))
+            self.assertFalse(self.kf.is_accepted(d))
+
+    def test_noise_is_rejected(self):
+        for kind in ['white', 'brown', 'hum']:
+            _, d = self.kf.match(self.noise(kind))
+            self.assertTrue(self.kf.is_rejected(d), kind)
+
+
+if __name__ == '__main__':
+    unittest.main()
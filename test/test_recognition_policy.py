@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+PKG = 'ros_speech2text'
+
+import unittest
+from collections import namedtuple
+from unittest import TestCase
+
+from google.gax.errors import GaxError
+
+from ros_speech2text.recognition_policy import (LatencyStats,
+                                                PendingRecognition,
+                                                RequestPolicy,
+                                                is_transient_code,
+                                                is_transient_error)
+from ros_speech2text.speech_recognition import SpeechRecognizer
+
+
+class TestLatencyStats(TestCase):
+    def test_empty(self):
+        ls = LatencyStats()
+        self.assertIsNone(ls.mean)
+        self.assertIsNone(ls.percentile(95))
+
+    def test_mean_and_percentile(self):
+        ls = LatencyStats()
+        for l in range(1, 101):
+            ls.add(l)
+        self.assertEqual(ls.mean, 50.5)
+        self.assertAlmostEqual(ls.percentile(95), 95.05)
+
+    def test_keeps_most_recent(self):
+        ls = LatencyStats(maxlen=2)
+        for l in [10, 1, 3]:
+            ls.add(l)
+        self.assertEqual(ls.mean, 2.)
+
+
+class TestRequestPolicy(TestCase):
+    def test_retry_delay_is_bounded(self):
+        policy = RequestPolicy(backoff=1., max_backoff=3.)
+        for n in range(5):
+            d = policy.retry_delay(n)
+            self.assertTrue(0 <= d <= min(3., 2 ** n))
+
+    def test_schedule_retry(self):
+        policy = RequestPolicy(max_retries=1, backoff=1.)
+        pending = PendingRecognition(0, None, None, 0.)
+        self.assertTrue(policy.schedule_retry(pending, 10.))
+        self.assertTrue(10. <= pending.next_retry <= 11.)
+        self.assertFalse(policy.schedule_retry(pending, 10.))
+        self.assertEqual(policy.n_retries, 1)
+
+    def test_deadline(self):
+        pending = PendingRecognition(0, None, None, 0.)
+        self.assertFalse(RequestPolicy().is_expired(pending, 1000.))
+        policy = RequestPolicy(deadline=5.)
+        self.assertFalse(policy.is_expired(pending, 4.))
+        self.assertTrue(policy.is_expired(pending, 6.))
+
+    def get_hedging_policy(self):
+        policy = RequestPolicy(hedge=True, hedge_min_samples=10)
+        for l in range(10):
+            pending = PendingRecognition(0, None, None, 0.)
+            policy.record_success(pending, 0., False, 1. + l)
+        return policy
+
+    def test_no_hedge_without_samples(self):
+        policy = RequestPolicy(hedge=True)
+        pending = PendingRecognition(0, None, None, 0.)
+        pending.add_operation(None, 0.)
+        self.assertFalse(policy.should_hedge(pending, 100.))
+
+    def test_hedge_after_percentile(self):
+        policy = self.get_hedging_policy()  # p95 is 9.55
+        pending = PendingRecognition(0, None, None, 0.)
+        pending.add_operation(None, 0.)
+        self.assertFalse(policy.should_hedge(pending, 9.))
+        self.assertTrue(policy.should_hedge(pending, 10.))
+
+    def test_hedge_only_once(self):
+        policy = self.get_hedging_policy()
+        pending = PendingRecognition(0, None, None, 0.)
+        pending.add_operation(None, 0.)
+        pending.add_operation(None, 10., hedge=True)
+        pending.operations.pop(0)
+        self.assertFalse(policy.should_hedge(pending, 100.))
+
+    def test_hedge_stats(self):
+        policy = RequestPolicy(hedge=True)
+        pending = PendingRecognition(0, None, None, 0.)
+        policy.record_submission()
+        pending.add_operation(None, 0.)
+        policy.record_submission(hedge=True)
+        pending.add_operation(None, 2., hedge=True)
+        policy.record_success(pending, 2., True, 3.)
+        self.assertEqual(policy.n_hedge_wins, 1)
+        # Lower bound of the latency of the original request
+        self.assertEqual(policy.request_latencies.mean, 3.)
+        self.assertEqual(policy.hedged_latencies.mean, 3.)
+        self.assertIn('hedge rate: 1.00', policy.report())
+
+
+class FakeCode(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeRpcError(Exception):
+    def __init__(self, name):
+        super(FakeRpcError, self).__init__(name)
+        self._code = FakeCode(name)
+
+    def code(self):
+        return self._code
+
+
+def gax_error(code_name):
+    return GaxError(code_name, cause=FakeRpcError(code_name))
+
+
+Status = namedtuple('Status', ['code'])
+Result = namedtuple('Result', ['transcript', 'confidence'])
+
+
+class FakeOperation(object):
+    def __init__(self, poll_error=None):
+        self.complete = False
+        self.results = None
+        self.error = None
+        self.poll_error = poll_error
+        self.n_polls = 0
+
+    def finish(self, results=None, error=None):
+        self.complete = True
+        self.results = results
+        self.error = error
+
+    def poll(self):
+        self.n_polls += 1
+        if self.poll_error is not None:
+            raise self.poll_error
+
+
+class FakeRecognizer(SpeechRecognizer):
+    """Recognizer with fake requests; does not start the node."""
+
+    def __init__(self, policy, requests):
+        self.policy = policy
+        self.requests = list(requests)  # operations or errors to return
+        self.decoded = []
+        self.failed = []
+
+    def recog(self, utterance_id):
+        request = self.requests.pop(0)
+        if isinstance(request, Exception):
+            raise request
+        return request
+
+    def utterance_decoded(self, utterance_id, transcription, confidence,
+                          start_time, end_time):
+        self.decoded.append((utterance_id, transcription))
+
+    def utterance_failed(self, utterance_id, start_time, end_time):
+        self.failed.append(utterance_id)
+
+
+class TestTransientErrors(TestCase):
+    def test_codes(self):
+        self.assertTrue(is_transient_code(FakeCode('UNAVAILABLE')))
+        self.assertTrue(is_transient_code(14))
+        self.assertFalse(is_transient_code(FakeCode('INVALID_ARGUMENT')))
+        self.assertFalse(is_transient_code(3))
+
+    def test_errors(self):
+        self.assertTrue(is_transient_error(gax_error('DEADLINE_EXCEEDED')))
+        self.assertTrue(is_transient_error(IOError()))
+        self.assertFalse(is_transient_error(gax_error('PERMISSION_DENIED')))
+        self.assertFalse(is_transient_error(GaxError('no cause')))
+
+
+class TestCheckPending(TestCase):
+    def submit(self, recognizer, now=0.):
+        pending = PendingRecognition(0, None, None, now)
+        self.assertTrue(recognizer.submit(pending, now=now))
+        return pending
+
+    def test_decoded(self):
+        op = FakeOperation()
+        r = FakeRecognizer(RequestPolicy(), [op])
+        pending = self.submit(r)
+        self.assertFalse(r.check_pending(pending, now=1.))
+        op.finish(results=[Result('hello', .9)])
+        self.assertTrue(r.check_pending(pending, now=2.))
+        self.assertEqual(r.decoded, [(0, 'hello')])
+
+    def test_transient_poll_error_polls_again(self):
+        op = FakeOperation(poll_error=gax_error('UNAVAILABLE'))
+        r = FakeRecognizer(RequestPolicy(), [op])
+        pending = self.submit(r)
+        self.assertFalse(r.check_pending(pending, now=1.))
+        self.assertFalse(r.check_pending(pending, now=2.))
+        self.assertEqual(op.n_polls, 2)
+        self.assertEqual(r.requests, [])  # Not sent again
+        op.finish(results=[Result('hello', .9)])
+        self.assertTrue(r.check_pending(pending, now=3.))
+        self.assertEqual(r.decoded, [(0, 'hello')])
+
+    def test_permanent_poll_error_fails(self):
+        op = FakeOperation(poll_error=gax_error('PERMISSION_DENIED'))
+        r = FakeRecognizer(RequestPolicy(), [op])
+        pending = self.submit(r)
+        self.assertTrue(r.check_pending(pending, now=1.))
+        self.assertEqual(r.failed, [0])
+
+    def test_poll_error_bounded_by_deadline(self):
+        op = FakeOperation(poll_error=gax_error('UNAVAILABLE'))
+        r = FakeRecognizer(RequestPolicy(deadline=5.), [op])
+        pending = self.submit(r)
+        self.assertFalse(r.check_pending(pending, now=4.))
+        self.assertTrue(r.check_pending(pending, now=6.))
+        self.assertEqual(r.failed, [0])
+        self.assertEqual(r.policy.n_timeouts, 1)
+
+    def test_retry_after_transient_submission_error(self):
+        op = FakeOperation()
+        r = FakeRecognizer(RequestPolicy(backoff=1.),
+                           [gax_error('UNAVAILABLE'), op])
+        pending = self.submit(r)
+        self.assertEqual(pending.operations, [])
+        self.assertFalse(r.check_pending(pending, now=2.))  # Resubmitted
+        self.assertEqual(pending.operations[0][0], op)
+        self.assertEqual(r.policy.n_retries, 1)
+
+    def test_no_retry_on_permanent_submission_error(self):
+        r = FakeRecognizer(RequestPolicy(), [gax_error('INVALID_ARGUMENT')])
+        pending = PendingRecognition(0, None, None, 0.)
+        self.assertFalse(r.submit(pending, now=0.))
+        self.assertEqual(r.policy.n_retries, 0)
+
+    def test_retry_after_transient_operation_error(self):
+        op1, op2 = FakeOperation(), FakeOperation()
+        r = FakeRecognizer(RequestPolicy(backoff=1.), [op1, op2])
+        pending = self.submit(r)
+        op1.finish(error=Status(14))
+        self.assertFalse(r.check_pending(pending, now=1.))  # Scheduled
+        self.assertFalse(r.check_pending(pending, now=3.))  # Resubmitted
+        self.assertEqual(pending.operations[0][0], op2)
+        self.assertEqual(r.failed, [])
+
+    def test_no_results_fails_without_retry(self):
+        op = FakeOperation()
+        r = FakeRecognizer(RequestPolicy(), [op, FakeOperation()])
+        pending = self.submit(r)
+        op.finish()
+        self.assertTrue(r.check_pending(pending, now=1.))
+        self.assertEqual(r.failed, [0])
+        self.assertEqual(len(r.requests), 1)  # Not sent again
+
+    def get_hedging_policy(self):
+        policy = RequestPolicy(hedge=True, hedge_min_samples=10)
+        for l in range(10):
+            policy.request_latencies.add(1.)
+        return policy
+
+    def test_no_results_while_hedge_pending(self):
+        op, hedge = FakeOperation(), FakeOperation()
+        r = FakeRecognizer(self.get_hedging_policy(), [op, hedge])
+        pending = self.submit(r)
+        self.assertFalse(r.check_pending(pending, now=2.))  # Hedged
+        self.assertEqual(len(pending.operations), 2)
+        op.finish()
+        self.assertFalse(r.check_pending(pending, now=3.))
+        self.assertEqual(r.failed, [])
+        hedge.finish()
+        self.assertTrue(r.check_pending(pending, now=4.))
+        self.assertEqual(r.failed, [0])
+
+    def test_hedge_win(self):
+        op, hedge = FakeOperation(), FakeOperation()
+        r = FakeRecognizer(self.get_hedging_policy(), [op, hedge])
+        pending = self.submit(r)
+        self.assertFalse(r.check_pending(pending, now=2.))  # Hedged
+        hedge.finish(results=[Result('hello', .9)])
+        self.assertTrue(r.check_pending(pending, now=3.))
+        self.assertEqual(r.decoded, [(0, 'hello')])
+        self.assertEqual(r.policy.n_hedges, 1)
+        self.assertEqual(r.policy.n_hedge_wins, 1)
+        self.assertEqual(len(r.policy.request_latencies), 11)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+PKG = 'ros_speech2text'
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import TestCase
+
+import numpy as np
+
+from ros_speech2text.shared_audio import (AudioRing, SharedUtteranceAudio,
+                                          UtteranceAudioReader)
+
+
+class TestAudioRing(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'ring')
+        self.ring = AudioRing(self.path, capacity=10, create=True)
+
+    def tearDown(self):
+        self.ring.close()
+        shutil.rmtree(self.dir)
+
+    def test_write_and_view(self):
+        p = self.ring.write(np.arange(4, dtype=np.int16))
+        self.assertEqual(p, 0)
+        np.testing.assert_array_equal(self.ring.view(p, 4), np.arange(4))
+
+    def test_wraps_to_keep_contiguous(self):
+        self.ring.write(np.arange(6, dtype=np.int16))
+        p = self.ring.write(np.arange(5, dtype=np.int16))
+        self.assertEqual(p, 10)
+        self.assertEqual(self.ring.offset(p), 0)
+        np.testing.assert_array_equal(self.ring.view(p, 5), np.arange(5))
+
+    def test_overwritten_is_invalid(self):
+        p1 = self.ring.write(np.arange(4, dtype=np.int16))
+        p2 = self.ring.write(np.arange(4, dtype=np.int16))
+        self.ring.write(np.arange(4, dtype=np.int16))
+        self.assertFalse(self.ring.is_valid(p1, 4))
+        self.assertTrue(self.ring.is_valid(p2, 4))
+        self.assertRaises(ValueError, self.ring.view, p1, 4)
+
+    def test_too_long(self):
+        self.assertRaises(ValueError, self.ring.write,
+                          np.zeros((11, ), dtype=np.int16))
+
+    def test_read_from_other_mapping(self):
+        p = self.ring.write(np.arange(4, dtype=np.int16))
+        other = AudioRing(self.path)
+        self.assertEqual(other.capacity, 10)
+        np.testing.assert_array_equal(other.view(p, 4), np.arange(4))
+        other.close()
+
+
+class TestSharedUtteranceAudio(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.shared = SharedUtteranceAudio(
+            os.path.join(self.dir, 'audio'), 10, seconds=1.)
+
+    def tearDown(self):
+        self.shared.close()
+        shutil.rmtree(self.dir)
+
+    def test_listener(self):
+        received = []
+        self.shared.add_listener(lambda d, s: received.append((d, s.copy())))
+        d = self.shared.add(3, np.arange(4, dtype=np.int16), 1., 2.)
+        self.assertEqual(len(received), 1)
+        self.assertEqual(received[0][0], d)
+        self.assertEqual((d.utterance_id, d.length, d.sample_rate), (3, 4, 10))
+        np.testing.assert_array_equal(received[0][1], np.arange(4))
+
+    def test_get_by_id(self):
+        self.shared.add(0, np.arange(4, dtype=np.int16), 1., 2.)
+        self.shared.add(1, np.ones((4, ), dtype=np.int16), 3., 4.)
+        np.testing.assert_array_equal(self.shared.get(0), np.arange(4))
+        self.assertIsNone(self.shared.get(2))
+        self.shared.add(2, np.ones((4, ), dtype=np.int16), 5., 6.)
+        self.assertIsNone(self.shared.get(0))
+
+    def test_reader(self):
+        d = self.shared.add(0, np.arange(4, dtype=np.int16), 1., 2.)
+        reader = UtteranceAudioReader()
+        reader.add_descriptor(d)
+        np.testing.assert_array_equal(reader.get(0), np.arange(4))
+        self.assertFalse(reader.get(0).flags.writeable)
+        reader.close()
+
+    def test_view_outlives_close(self):
+        self.shared.add(0, np.arange(4, dtype=np.int16), 1., 2.)
+        reader = UtteranceAudioReader()
+        reader.add_descriptor(self.shared.descriptor(0))
+        samples = reader.get(0)
+        reader.close()
+        np.testing.assert_array_equal(samples, np.arange(4))
+
+    def test_faulty_listener(self):
+        received = []
+
+        def faulty(d, s):
+            raise RuntimeError()
+
+        self.shared.add_listener(faulty)
+        self.shared.add_listener(lambda d, s: received.append(d))
+        d = self.shared.add(0, np.arange(4, dtype=np.int16), 1., 2.)
+        self.assertEqual(received, [d])
+
+    def test_removed_buffer(self):
+        d = self.shared.add(0, np.arange(4, dtype=np.int16), 1., 2.)
+        reader = UtteranceAudioReader()
+        reader.add_descriptor(d)
+        # The node terminated and removed its buffer
+        self.shared.close()
+        self.shared = SharedUtteranceAudio(
+            os.path.join(self.dir, 'other'), 10, seconds=1.)
+        self.assertFalse(reader.is_available(0))
+        self.assertIsNone(reader.get(0))
+
+    def test_max_utterances(self):
+        reader = UtteranceAudioReader(max_utterances=1)
+        d0 = self.shared.add(0, np.arange(2, dtype=np.int16), 1., 2.)
+        d1 = self.shared.add(1, np.arange(2, dtype=np.int16), 3., 4.)
+        reader.add_descriptor(d0)
+        reader.add_descriptor(d1)
+        self.assertIsNone(reader.descriptor(0))
+        self.assertEqual(reader.descriptor(1), d1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,8 +11,8 @@ import rospkg
 import rospy
 from ros_speech2text.msg import transcript
 from s2t.speech_detection import (NORMAL_MAXIMUM, DynamicSilenceDetector,
-                                  StaticSilenceDetector, add_silence,
-                                  normalize)
+                                  SpeechDetector, StaticSilenceDetector,
+                                  add_silence, normalize)
 from std_msgs.msg import String
 
 
@@ -126,3 +126,62 @@ class TestDynamicSilenceDetector(TestCase):
         # Hence sd.avg_volume == 2
         sd.reset_average()
         self.assertEqual(sd.average_volume, 1.5)
+
+
+class TestSelfSpeechGating(TestCase):
+    loud = 1000 * np.ones((10, ), dtype=np.int16)
+    quiet = np.ones((10, ), dtype=np.int16)
+
+    def get_detector(self, **kwargs):
+        return SpeechDetector(100, 50., dynamic_threshold=True, chunk_size=10,
+                              min_average_volume=1., **kwargs)
+
+    def test_no_utterance_while_robot_speaking(self):
+        sd = self.get_detector()
+        sd.set_robot_speaking(True)
+        for _ in range(5):
+            sd.treat_chunk(self.loud)
+        self.assertFalse(sd.in_utterance)
+        self.assertEqual(sd.chunks, [])
+
+    def test_average_frozen_while_robot_speaking(self):
+        sd = self.get_detector()
+        sd.treat_chunk(self.quiet)
+        avg = sd.silence_detect.average_volume
+        sd.set_robot_speaking(True)
+        sd.treat_chunk(self.loud)
+        sd.treat_chunk(self.quiet)
+        self.assertEqual(sd.silence_detect.average_volume, avg)
+
+    def test_skipped_triggers_counted_once_per_burst(self):
+        sd = self.get_detector()
+        sd.set_robot_speaking(True)
+        for chunk in 5 * [self.loud] + [self.quiet] + 3 * [self.loud]:
+            sd.treat_chunk(chunk)
+        self.assertEqual(sd.n_skipped_triggers, 2)
+
+    def test_guard_after_robot_speaking(self):
+        sd = SpeechDetector(100, 100., chunk_size=10,
+                            self_speech_guard=.2)  # 2 chunks
+        sd.set_robot_speaking(True)
+        sd.set_robot_speaking(False)
+        sd.treat_chunk(self.loud)
+        sd.treat_chunk(self.loud)
+        self.assertFalse(sd.in_utterance)
+        sd.treat_chunk(self.loud)
+        self.assertTrue(sd.in_utterance)
+
+    def test_default_guard(self):
+        sd = SpeechDetector(100, 100., chunk_size=10)
+        self.assertEqual(sd.guard_chunks, 5)
+
+
+class TestRawUtterance(TestCase):
+    def test_raw_chunks_not_duplicated(self):
+        sd = SpeechDetector(100, 50., dynamic_threshold=True, chunk_size=2,
+                            dynamic_threshold_frame=2, min_average_volume=1.)
+        for v in [1000, 2000]:
+            sd.treat_chunk(v * np.ones((2, ), dtype=np.int16))
+        self.assertTrue(sd.in_utterance)
+        np.testing.assert_array_equal(sd.raw_utterance,
+                                      [1000, 1000, 2000, 2000])